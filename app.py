@@ -1,12 +1,18 @@
-from flask import Flask, render_template, request, redirect, flash, url_for
+from flask import Flask, render_template, request, redirect, flash, url_for, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select, update, case, func, literal, literal_column
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import (
     LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 )
 from urllib.parse import urlparse, urljoin
 from datetime import datetime
+from functools import wraps
+import bisect
 import os
+import threading
+import time
 
 # --- Flask Setup ---
 # Use instance_relative_config=True so the database file is stored in /instance
@@ -15,6 +21,19 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(app.instance_path, 'greenlife.db')}"
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Werkzeug's default (scrypt) is deliberately slow; dev/test can set e.g.
+# PW_HASH_METHOD=pbkdf2:sha256:10000 to speed up logins and signups
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PW_HASH_METHOD', 'scrypt')
+# In debug mode, warn when a single request runs more SQL statements than this
+app.config['QUERY_COUNT_WARN'] = int(os.environ.get('QUERY_COUNT_WARN', 10))
+# Keep SQLite connections pooled across requests instead of reconnecting each time
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+}
 
 # Ensure instance folder exists (so SQLite can create the DB file)
 try:
@@ -30,6 +49,7 @@ login_manager.login_message_category = 'info'
 
 # --- Models ---
 class User(UserMixin, db.Model):
+    role = 'user'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=True)
@@ -38,14 +58,16 @@ class User(UserMixin, db.Model):
     points = db.Column(db.Integer, default=0)
     address = db.Column(db.String(300), nullable=True)
     tree_level = db.Column(db.Integer, default=0)
+    __table_args__ = (db.Index('ix_user_points_desc', points.desc()),)
 
-    def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+    def get_id(self):
+        return f"u:{self.id}"
 
-    def check_password(self, pw):
-        return self.password_hash and check_password_hash(self.password_hash, pw)
+    def set_password(self, pw):
+        self.password_hash = generate_password_hash(pw, method=app.config['PASSWORD_HASH_METHOD'])
 
 class Rider(UserMixin, db.Model):
+    role = 'rider'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
     email = db.Column(db.String(150), unique=True, nullable=False)
@@ -53,11 +75,11 @@ class Rider(UserMixin, db.Model):
     password_hash = db.Column(db.String(200))
     is_active = db.Column(db.Boolean, default=True)
 
-    def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+    def get_id(self):
+        return f"r:{self.id}"
 
-    def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
+    def set_password(self, pw):
+        self.password_hash = generate_password_hash(pw, method=app.config['PASSWORD_HASH_METHOD'])
 
 class Pickup(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -70,6 +92,7 @@ class Pickup(db.Model):
     status = db.Column(db.String(50), default='requested')
     rider_id = db.Column(db.Integer, db.ForeignKey('rider.id'), nullable=True)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
+    __table_args__ = (db.Index('ix_pickup_user', 'user_id'),)
 
 class Challenge(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -86,6 +109,34 @@ class UserChallenge(db.Model):
 
 
 # --- Helpers ---
+# (emoji, name, minimum tree_level), in ascending order of level
+_TREE_STAGES = (
+    ("🌱", "Seedling", 0),
+    ("🌿", "Sprout", 5),
+    ("🌳", "Small Tree", 10),
+    ("🌲", "Growing Forest", 20),
+    ("🏞️", "Lush Ecosystem", 50)
+)
+_TREE_THRESHOLDS = [s[2] for s in _TREE_STAGES]
+
+_REWARDS = (
+    {"tier": "Bronze", "points": 50, "reward": "Reusable Bag"},
+    {"tier": "Silver", "points": 100, "reward": "Eco Bottle"},
+    {"tier": "Gold", "points": 200, "reward": "Tree Plantation"},
+    {"tier": "Platinum", "points": 500, "reward": "Community Recognition"}
+)
+
+_POINTS_MAP = {
+    "Plastic Bottles": 2, "Cardboard": 5, "Electronics": 10,
+    "Metal": 8, "Glass": 6, "E-Waste": 12
+}
+
+# kg of CO2 saved per unit recycled
+_CARBON_MAP = {
+    "Plastic Bottles": 2.5, "Cardboard": 1.2, "Electronics": 5.0,
+    "Metal": 3.0, "Glass": 0.8, "E-Waste": 5.0
+}
+
 def create_dummy_challenges():
     if Challenge.query.count() == 0:
         print("Creating dummy challenges...")
@@ -98,19 +149,159 @@ def create_dummy_challenges():
     else:
         print("Challenges already exist.")
 
+def set_sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets readers run alongside the writer and NORMAL sync skips the
+    # per-commit fsync of the rollback journal
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=134217728")
+    cur.close()
+
+def ensure_indexes():
+    # create_all() skips tables that already exist, so add any new indexes here
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+def warn_on_query_count(response):
+    count = g.get('query_count', 0)
+    if count > app.config['QUERY_COUNT_WARN']:
+        app.logger.warning("%s %s ran %d SQL queries (possible N+1)",
+                           request.method, request.path, count)
+    return response
+
+def enable_query_counter():
+    # Debug-only N+1 detector: count statements per request and log outliers
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+    app.after_request(warn_on_query_count)
+
 def init_db():
     with app.app_context():
         db.create_all()
+        ensure_indexes()
         create_dummy_challenges()
 
 def calculate_points(item, qty):
-    points_map = {
-        "Plastic Bottles": 2, "Cardboard": 5, "Electronics": 10,
-        "Metal": 8, "Glass": 6, "E-Waste": 12
-    }
     try: qty_int = int(qty)
-    except (ValueError, TypeError): qty_int = 0
-    return points_map.get(item, 1) * qty_int
+    except (ValueError, TypeError): return 0
+    return _POINTS_MAP.get(item, 1) * qty_int
+
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry expiry and a size cap."""
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}  # key -> (timestamp, value), oldest insert first
+        self._loading = {}  # key -> token for loads in flight; pop() discards it
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            token = self._loading.setdefault(key, object())
+        try:
+            value = loader()
+        except Exception:
+            with self._lock:
+                if self._loading.get(key) is token:
+                    del self._loading[key]
+            raise
+        with self._lock:
+            # Skip the store if this key was invalidated while we were loading,
+            # otherwise stale data would be cached with a fresh timestamp
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                self._store(key, value)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            self._loading.pop(key, None)
+            self._data.pop(key, None)
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        self._data.pop(key, None)
+        if len(self._data) >= self.maxsize:
+            for k in [k for k, (ts, _) in self._data.items() if now - ts >= self.ttl]:
+                del self._data[k]
+            while len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+        self._data[key] = (now, value)
+
+# Leaderboard changes slowly, so keep the top 20 in memory for a short while
+_LB_CACHE = TTLCache(ttl=60, maxsize=1)
+
+def get_leaderboard():
+    return _LB_CACHE.get_or_load('top20', load_leaderboard)
+
+def load_leaderboard():
+    return db.session.execute(
+        select(User.name, func.coalesce(User.points, 0))
+        .order_by(User.points.desc()).limit(20)
+    ).all()
+
+def invalidate_leaderboard():
+    _LB_CACHE.pop('top20')
+
+# Per-user dashboard totals
+_DASHBOARD_CACHE = TTLCache(ttl=60)
+
+def get_dashboard_stats(user_id):
+    return _DASHBOARD_CACHE.get_or_load(user_id, lambda: load_dashboard_stats(user_id))
+
+def load_dashboard_stats(user_id):
+    # Counts and sums cover all pickups (any status) to show immediate impact;
+    # the carbon weighting is applied in SQL via a CASE on item_type
+    carbon_per_unit = case(_CARBON_MAP, value=Pickup.item_type, else_=0.5)
+    rows = db.session.execute(
+        select(Pickup.item_type, func.sum(Pickup.quantity), func.count(),
+               func.sum(carbon_per_unit * Pickup.quantity))
+        .where(Pickup.user_id == user_id)
+        .group_by(Pickup.item_type)
+    ).all()
+
+    stats = {}
+    total_pickups = 0
+    total_carbon_saved = 0
+    for item, quantity, count, carbon in rows:
+        stats[item] = quantity
+        total_pickups += count
+        total_carbon_saved += carbon or 0
+
+    return stats, total_pickups, total_carbon_saved
+
+def invalidate_dashboard(user_id):
+    _DASHBOARD_CACHE.pop(user_id)
+
+# Per-user challenge list with completion flags
+_CHALLENGES_CACHE = TTLCache(ttl=120)
+
+def get_user_challenges(user_id):
+    return _CHALLENGES_CACHE.get_or_load(user_id, lambda: load_user_challenges(user_id))
+
+def load_user_challenges(user_id):
+    # One LEFT JOIN yields each challenge with whether this user completed it.
+    # Plain column rows are cached rather than ORM objects tied to a session.
+    return db.session.execute(
+        select(Challenge.id, Challenge.title, Challenge.description, Challenge.points_reward,
+               UserChallenge.id.isnot(None).label('is_done'))
+        .outerjoin(UserChallenge, (UserChallenge.challenge_id == Challenge.id) &
+                                  (UserChallenge.user_id == user_id))
+    ).all()
+
+def invalidate_user_challenges(user_id):
+    _CHALLENGES_CACHE.pop(user_id)
 
 def is_safe_url(target):
     if not target: return False
@@ -125,28 +316,42 @@ def inject_now():
 # --- Flask-Login ---
 @login_manager.user_loader
 def load_user(user_id):
-    u = db.session.get(User, int(user_id))
-    if u:
-        return u
-    return db.session.get(Rider, int(user_id))
+    # IDs are tagged with their table ("u:42" / "r:42") so only one lookup runs
+    kind, _, pk = user_id.partition(':')
+    model = {'u': User, 'r': Rider}.get(kind)
+    if model is None or not pk.isdigit():
+        return None
+    return db.session.get(model, int(pk))
+
+def user_only(view):
+    # Compare the plain role string rather than isinstance() on the proxy
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if getattr(current_user, 'role', None) != 'user':
+            return redirect(url_for('rider_dashboard'))
+        return view(*args, **kwargs)
+    return wrapped
 
 # --- Ensure DB exists and seed challenges immediately (Flask 3.1 compatible) ---
 with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
     db.create_all()
+    ensure_indexes()
     try:
         if not Challenge.query.count():
             create_dummy_challenges()
     except Exception as e:
         print("DB seed error:", e)
 
+if app.debug:
+    enable_query_counter()
+
 
 # --- Main Routes ---
 @app.route("/", methods=["GET", "POST"])
 @login_required
+@user_only
 def index():
-    if not isinstance(current_user, User):
-        return redirect(url_for('rider_dashboard'))
-    
     if request.method == "POST":
         item = request.form['item']
         qty = int(request.form['quantity'])
@@ -162,9 +367,13 @@ def index():
         db.session.add(p)
         
         # --- FIX: Increase tree_level on submission, not completion ---
-        current_user.tree_level = (current_user.tree_level or 0) + 1
+        db.session.execute(
+            update(User).where(User.id == current_user.id)
+            .values(tree_level=func.coalesce(User.tree_level, 0) + 1),
+            execution_options={'synchronize_session': False})
         
         db.session.commit()
+        invalidate_dashboard(current_user.id)
         
         # This message is still correct and tells the user what to expect!
         flash('Your pickup is scheduled! Points will be credited after pickup.')
@@ -175,48 +384,19 @@ def index():
 @app.route("/leaderboard")
 @login_required
 def leaderboard():
-    users = User.query.order_by(User.points.desc()).limit(20).all()
-    return render_template("leaderboard.html", users=[(u.name, u.points or 0) for u in users])
+    return render_template("leaderboard.html", users=get_leaderboard())
 
 @app.route("/rewards")
 @login_required
+@user_only
 def rewards():
-    if not isinstance(current_user, User):
-        flash("Rewards are for users only.")
-        return redirect(url_for('index'))
-    rewards_data = [
-        {"tier": "Bronze", "points": 50, "reward": "Reusable Bag"},
-        {"tier": "Silver", "points": 100, "reward": "Eco Bottle"},
-        {"tier": "Gold", "points": 200, "reward": "Tree Plantation"},
-        {"tier": "Platinum", "points": 500, "reward": "Community Recognition"}
-    ]
-    return render_template("rewards.html", rewards=rewards_data)
+    return render_template("rewards.html", rewards=_REWARDS)
 
 @app.route("/dashboard")
 @login_required
+@user_only
 def dashboard():
-    if not isinstance(current_user, User):
-        return redirect(url_for('rider_dashboard'))
-
-    # --- FIX: Count all pickups (any status) to show immediate impact ---
-    total_pickups = Pickup.query.filter_by(user_id=current_user.id).count()
-    
-    # --- FIX: Calculate stats based on all pickups (any status) ---
-    items_saved_query = db.session.query(
-        Pickup.item_type, 
-        db.func.sum(Pickup.quantity)
-    ).filter_by(user_id=current_user.id).group_by(Pickup.item_type).all()
-    
-    carbon_map = {
-        "Plastic Bottles": 2.5, "Cardboard": 1.2, "Electronics": 5.0,
-        "Metal": 3.0, "Glass": 0.8, "E-Waste": 5.0
-    }
-    
-    stats = {}
-    total_carbon_saved = 0
-    for item, quantity in items_saved_query:
-        stats[item] = quantity
-        total_carbon_saved += carbon_map.get(item, 0.5) * quantity
+    stats, total_pickups, total_carbon_saved = get_dashboard_stats(current_user.id)
 
     return render_template("dashboard.html", 
                            stats=stats, 
@@ -225,71 +405,49 @@ def dashboard():
 
 @app.route("/challenges")
 @login_required
+@user_only
 def challenges():
-    if not isinstance(current_user, User):
-        return redirect(url_for('rider_dashboard'))
-    
-    all_challenges = Challenge.query.all()
-    completed_query = db.session.query(UserChallenge.challenge_id).filter_by(user_id=current_user.id).all()
-    completed_ids = {c[0] for c in completed_query}
-
-    return render_template("challenges.html", 
-                           challenges=all_challenges, 
-                           completed_ids=completed_ids)
+    return render_template("challenges.html", challenges=get_user_challenges(current_user.id))
 
 @app.route("/challenges/complete/<int:challenge_id>", methods=["POST"])
 @login_required
+@user_only
 def complete_challenge(challenge_id):
-    if not isinstance(current_user, User):
-        return redirect(url_for('rider_dashboard'))
-        
     challenge = db.session.get(Challenge, challenge_id)
     if not challenge:
         flash("Challenge not found!")
         return redirect(url_for('challenges'))
 
-    existing = UserChallenge.query.filter_by(user_id=current_user.id, challenge_id=challenge_id).first()
-    if existing:
-        flash("You already completed this challenge!")
-        return redirect(url_for('challenges'))
-    
     new_completion = UserChallenge(user_id=current_user.id, challenge_id=challenge_id)
     db.session.add(new_completion)
     
-    current_user.points = (current_user.points or 0) + challenge.points_reward
-    db.session.commit()
+    # _user_challenge_uc rejects repeats, so no existence check is needed first
+    try:
+        # Increment in SQL so concurrent awards can't overwrite each other
+        db.session.execute(
+            update(User).where(User.id == current_user.id)
+            .values(points=func.coalesce(User.points, 0) + challenge.points_reward),
+            execution_options={'synchronize_session': False})
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash("You already completed this challenge!")
+        return redirect(url_for('challenges'))
+    invalidate_leaderboard()
+    invalidate_user_challenges(current_user.id)
     
     flash(f"Challenge completed! You earned {challenge.points_reward} points! 🎉")
     return redirect(url_for('challenges'))
 
 @app.route("/forest")
 @login_required
+@user_only
 def forest():
-    if not isinstance(current_user, User):
-        return redirect(url_for('rider_dashboard'))
-    
     level = current_user.tree_level or 0
     
-    tree_stages = [
-        ("🌱", "Seedling", 0),
-        ("🌿", "Sprout", 5),
-        ("🌳", "Small Tree", 10),
-        ("🌲", "Growing Forest", 20),
-        ("🏞️", "Lush Ecosystem", 50)
-    ]
-    
-    current_stage = tree_stages[0]
-    next_stage = tree_stages[1]
-    
-    for i in range(len(tree_stages)):
-        if level >= tree_stages[i][2]:
-            current_stage = tree_stages[i]
-            if i + 1 < len(tree_stages):
-                next_stage = tree_stages[i+1]
-            else:
-                next_stage = None # Max level
-        else:
-            break
+    i = max(bisect.bisect_right(_TREE_THRESHOLDS, level) - 1, 0)
+    current_stage = _TREE_STAGES[i]
+    next_stage = _TREE_STAGES[i + 1] if i + 1 < len(_TREE_STAGES) else None # Max level
             
     progress_percent = 0
     if next_stage:
@@ -320,20 +478,18 @@ def signup():
             email = None
         # --- END FIX ---
 
-        if User.query.filter_by(name=name).first():
-            flash('Name already used', 'warning') # Added category
-            return redirect(url_for('signup'))
-        
-        # This check will now be skipped if email is None, which is correct.
-        if email and User.query.filter_by(email=email).first():
-            flash('Email already used', 'warning') # Added category
-            return redirect(url_for('signup'))
-
         u = User(name=name, email=email)
         if pw:
             u.set_password(pw)
         db.session.add(u)
-        db.session.commit()
+        # Let the UNIQUE constraints catch duplicates instead of checking first
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            name_taken = db.session.execute(select(1).where(User.name == name).limit(1)).scalar()
+            flash('Name already used' if name_taken else 'Email already used', 'warning')
+            return redirect(url_for('signup'))
         login_user(u)
         return redirect(url_for('index'))
     return render_template('signup.html')
@@ -346,15 +502,20 @@ def login():
         pw = request.form.get('password')
         posted_next = request.form.get('next') or next_page
 
-        u = User.query.filter((User.email == name_or_email) | (User.name == name_or_email)).first()
-        if u and u.check_password(pw):
-            login_user(u)
-            return redirect(posted_next if is_safe_url(posted_next) else url_for('index'))
-
-        r = Rider.query.filter_by(email=name_or_email).first()
-        if r and r.check_password(pw):
-            login_user(r)
-            return redirect(posted_next if is_safe_url(posted_next) else url_for('rider_dashboard'))
+        # Look up users and riders in one round trip; sorting on kind ('u' > 'r')
+        # makes sure user rows are tried before a rider with the same email
+        u_sel = select(literal('u').label('kind'), User.id, User.password_hash).where(
+            (User.email == name_or_email) | (User.name == name_or_email))
+        r_sel = select(literal('r'), Rider.id, Rider.password_hash).where(
+            Rider.email == name_or_email)
+        stmt = u_sel.union_all(r_sel).order_by(literal_column('kind').desc())
+        for kind, pk, pw_hash in db.session.execute(stmt).all():
+            if pw_hash and check_password_hash(pw_hash, pw):
+                if kind == 'u':
+                    login_user(db.session.get(User, pk))
+                    return redirect(posted_next if is_safe_url(posted_next) else url_for('index'))
+                login_user(db.session.get(Rider, pk))
+                return redirect(posted_next if is_safe_url(posted_next) else url_for('rider_dashboard'))
         flash("Invalid credentials")
     return render_template("login.html", next_page=next_page)
 
@@ -370,10 +531,13 @@ if __name__ == "__main__":
     # For local development only
     with app.app_context():
         db.create_all()
+        ensure_indexes()
         try:
             create_dummy_challenges()
         except Exception as e:
             print("DB init error:", e)
 
+    if not app.debug:
+        enable_query_counter()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
 